@@ -55,21 +55,14 @@ symbols_unique = MAGMA_financials['Symbol'].unique().tolist()
 
 years = ['2019', '2020', '2021', '2022']
 quarters = ['Q1', 'Q2', 'Q3', 'Q4']
-x = []
-y = []
-
-for _, row in MAGMA_financials.iterrows():
-    quarter_ended = row['Quarter Ended']
-    year, quarter = quarter_ended[:4], quarter_ended[4:]
-    symbol = row['Symbol']
-    net_income = row['Net Income']
-    x.append((year, quarter, symbol))
-    y.append(net_income)
-
-# using list comprehension and pandas methods
-x = [(row['Quarter Ended'][:4], row['Quarter Ended'][4:], row['Symbol'])
-     for _, row in MAGMA_financials.iterrows()]
-y = MAGMA_financials['Net Income'].tolist()
+# using vectorized string slicing on the columns instead of iterating over the rows
+quarter_ended = MAGMA_financials['Quarter Ended'].str
+x = list(zip(
+    quarter_ended[:4].to_numpy(),
+    quarter_ended[4:].to_numpy(),
+    MAGMA_financials['Symbol'].to_numpy()
+))
+y = MAGMA_financials['Net Income'].to_numpy().tolist()
 
 ## 1.4: Use ColumnDataSource to generate data sources
 
@@ -5,7 +5,7 @@ import pandas as pd
 from bokeh.plotting import figure 
 from bokeh.io import output_file, save
 from bokeh.layouts import column
-from bokeh.models import ColumnDataSource, CDSView, BooleanFilter, GroupFilter, \
+from bokeh.models import ColumnDataSource, CDSView, BooleanFilter, \
     HoverTool, LinearAxis, NumeralTickFormatter, Range1d, RangeTool
 
 # Task 1: Prepare the Data
@@ -17,7 +17,10 @@ stock = pd.read_csv(stock_url)
 ## 1.1: Convert the data type of time columns to datetime using "to_datetime()"
 
 # Column 'Date' in stock
-stock['Date'] =  pd.to_datetime(stock['Date'], format="%m/%d/%Y")
+# The same weekly dates repeat for every symbol,
+# so only the unique date strings are parsed and the result is mapped back to the rows
+dates = pd.Index(stock['Date'].unique())
+stock['Date'] = stock['Date'].map(pd.Series(pd.to_datetime(dates, format="%m/%d/%Y"), index=dates))
 
 # Task 2: Create A Candlestick Chart From the Stock Data
 
@@ -30,10 +33,18 @@ stock['Date'] =  pd.to_datetime(stock['Date'], format="%m/%d/%Y")
 # because you'll use CDSView filter later
 # which works with ColumnDataSource
 
+# Only META is shown, so the data is filtered to META first,
+# which keeps the other symbols out of the data source and the saved file
+meta = stock[stock['Symbol'] == 'META'].reset_index(drop=True)
 
 TOOLS = "pan,wheel_zoom,box_zoom,reset,save"
 
-source = ColumnDataSource(stock)
+# Only the columns used by the glyphs and the hover tool are put in the data source
+# ('Symbol' and 'Adj Close' are not drawn in the candlestick chart).
+# It is built from a dict of the column arrays, so that the index of the dataframe
+# is not added as a column either
+needed = ['Date', 'Open', 'High', 'Low', 'Close', 'Volume']
+source = ColumnDataSource({c: meta[c].to_numpy() for c in needed})
 
 p = figure(
     width=1200, 
@@ -41,7 +52,7 @@ p = figure(
     title='META',
     # Specify the x range to be (min date, max date)
     # so that you can refer to this range in other plots
-     x_range=(stock['Date'].min(), stock['Date'].max()),
+     x_range=(meta['Date'].min(), meta['Date'].max()),
     # Set the x axis to show date time
     x_axis_type='datetime',
     # Put the x axis to be at the top of the plot
@@ -63,8 +74,8 @@ p.yaxis.formatter = NumeralTickFormatter(format="0.0")
 # e.g. (min * 0.9, max * 1.1)
 # https://docs.bokeh.org/en/latest/docs/reference/models/ranges.html
 
-p.y_range.start = stock['Low'].min() * 0.9
-p.y_range.end = stock['High'].max() * 1.1
+p.y_range.start = meta['Low'].min() * 0.9
+p.y_range.end = meta['High'].max() * 1.1
 
 ## 2.3: Use CDSView to create two filters on the stock data
 
@@ -72,13 +83,11 @@ p.y_range.end = stock['High'].max() * 1.1
 # 'dec' does the opposite of 'inc' 
 # https://docs.bokeh.org/en/latest/docs/user_guide/basic/data.html#filtering-data
 
-inc = stock['Close'] > stock['Open']
-dec = stock['Close'] < stock['Open']
+inc = meta['Close'] > meta['Open']
+dec = meta['Close'] < meta['Open']
 
-filter = GroupFilter(column_name="Symbol", group="META")
-
-inc_view = CDSView(filter=BooleanFilter(inc) & filter)
-dec_view = CDSView(filter=BooleanFilter(dec) & filter)
+inc_view = CDSView(filter=BooleanFilter(inc))
+dec_view = CDSView(filter=BooleanFilter(dec))
 
 ## 2.4: Draw the glyphs in the candlesticks
 
@@ -107,8 +116,8 @@ p.vbar('Date', w, 'Open', 'Close', fill_color="red", line_color="#49a3a3", line_
 # https://docs.bokeh.org/en/latest/docs/user_guide/basic/axes.html
 # https://docs.bokeh.org/en/latest/docs/reference/models/axes.html#bokeh.models.LinearAxis
 
-y_volume = stock['Volume']
-p.extra_y_ranges['volume'] = Range1d(start=stock['Volume'].min(), end=stock['Volume'].max())
+y_volume = meta['Volume']
+p.extra_y_ranges['volume'] = Range1d(start=meta['Volume'].min(), end=meta['Volume'].max())
 
 y_volume_axis = LinearAxis(
     y_range_name='volume',
@@ -154,11 +163,8 @@ p.output_backend = 'svg'
 # a region in the candlestick chart
 # https://docs.bokeh.org/en/latest/docs/user_guide/topics/timeseries.html#range-tool
 
-# fliter data for the 'META' stock
-meta_stock = stock[stock['Symbol'] == 'META']
-
-# ColumnDataSource using 'Date' and 'Adj Close' 
-source_meta = ColumnDataSource(data=dict(date=meta_stock['Date'], close=meta_stock['Adj Close']))
+# ColumnDataSource using 'Date' and 'Adj Close' of the 'META' stock filtered above
+source_meta = ColumnDataSource(data=dict(date=meta['Date'], close=meta['Adj Close']))
 
 select = figure(
     height=130, width=1200,
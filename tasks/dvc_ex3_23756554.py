@@ -21,10 +21,17 @@
 # please install sciket-learn: 
 # https://scikit-learn.org/stable/install.html
 
+# import packages for caching the data on disk
+import os
+import time
+import hashlib
+import tempfile
+from pathlib import Path
+from urllib.request import urlretrieve
 # import packages for processing data
 import numpy as np
 import pandas as pd
-from pandas.api.types import is_numeric_dtype, is_object_dtype
+from pandas.api.types import is_numeric_dtype
 # import packages for principal component analysis and clustering
 from sklearn.decomposition import PCA
 # import packages for Multidimensional scaling
@@ -49,7 +56,31 @@ from bokeh.transform import factor_cmap
 # and 102 numerical columns (i.e. features).
 
 data_url = 'https://docs.google.com/spreadsheets/d/e/2PACX-1vQFGt2FAUh_Fb7XAtYasA95ut8X_4a6sqizwcF-QFHdxULsPCf0kXhqn3wJdxNE2Ogf-f1qwyeOIySw/pub?gid=1323235&single=true&output=csv'
-data = pd.read_csv(data_url)
+# The data is kept in a local file for an hour,
+# so that restarting the app reads it from disk instead of downloading it again.
+CACHE_TTL = 3600  # seconds
+cache_file = Path(tempfile.gettempdir()) / f'dvc_{hashlib.md5(data_url.encode()).hexdigest()}.csv'
+if not cache_file.exists() or time.time() - cache_file.stat().st_mtime >= CACHE_TTL:
+    # download into a temporary file next to the cache file and move it into place
+    # only when the download is complete, so that a broken download never ends up
+    # in the cache (the partial file is removed)
+    # (the temporary file has a unique name, so that app processes refreshing
+    # the cache at the same time never write into the same file)
+    fd, part_file = tempfile.mkstemp(dir=cache_file.parent, suffix='.part')
+    os.close(fd)
+    try:
+        urlretrieve(data_url, part_file)
+        os.replace(part_file, cache_file)
+    except BaseException:
+        if os.path.exists(part_file):
+            os.remove(part_file)
+        raise
+# Read only the header first to give the types of all columns to pandas,
+# so that it does not need to infer them:
+# the 5 categorical columns are strings and the numerical columns are read in single precision.
+headers = pd.read_csv(cache_file, nrows=0).columns
+dtypes = {**{c: str for c in headers[:5]}, **{c: 'float32' for c in headers[5:]}}
+data = pd.read_csv(cache_file, dtype=dtypes)
 num_data = data.iloc[:, 5:] ###answer
 
 ## Found 95 numerical colums, and 5 categorical columns
@@ -62,6 +93,10 @@ data_scaled = MinMaxScaler().fit_transform(num_data)
 imp = SimpleImputer(strategy='mean') ###answer
 
 data_imp = imp.fit_transform(data_scaled)
+# keep the matrix in single precision and row-major (C) order,
+# which is the layout MiniBatchKMeans and MDS work on without extra copies
+# (PCA gets its own column-major copy below)
+data_imp = np.ascontiguousarray(data_imp, dtype=np.float32)
 #print(np.isnan(data_imp).any())
 
 ## 1.1 Divide all data points into 2 groups according to the 102 numerical columns and assign a label to each point.
@@ -73,11 +108,32 @@ data_imp = imp.fit_transform(data_scaled)
 
 # sets the random seed to 0 so that the result is reproducible
 np.random.seed(0)
+
+# Feed the rows to the model in chunks of `batch_size` rows with partial_fit,
+# so that each update works on a block of rows small enough to stay in the cache
+# (512 rows of 102 float32 features are about 200 KB).
+# partial_fit initializes the centers once from the first chunk (`n_init` is not used),
+# so the rows are shuffled with the seed of the model before every pass:
+# otherwise the first chunk of a file sorted e.g. by Country would be a skewed sample.
+# The model is updated for a fixed number of passes instead of the early stopping of `fit`.
+# partial_fit only assigns labels to the last chunk, so the labels of all rows are predicted at the end.
+def fit_chunked(model, X, n_passes=10):
+    rng = np.random.default_rng(model.random_state)
+    for _ in range(n_passes):
+        X_pass = X[rng.permutation(len(X))]
+        for start in range(0, len(X), model.batch_size):
+            model.partial_fit(X_pass[start:start + model.batch_size])
+    return model.predict(X)
+
 # use MiniBatchKMeans to perform the clustering
-model = cluster.MiniBatchKMeans(n_clusters=2, n_init=2)
-model.fit(data_imp)
+# (a single initialization, see `fit_chunked`)
+model = cluster.MiniBatchKMeans(n_clusters=2, batch_size=512, n_init=1, random_state=0)
+labels = fit_chunked(model, data_imp)
 # append the cluster labels to the dataframe
-h_pred = model.labels_.astype(str)
+# the labels are 0 and 1, so they are turned into strings by looking them up in a table
+# of the two label strings, rather than by creating a new string for every point
+LBL = np.array(['0', '1'], dtype=object)
+h_pred = LBL[labels]
 data['H_Cluster'] = h_pred ###answer
 
 
@@ -88,8 +144,13 @@ data['H_Cluster'] = h_pred ###answer
 # You'll project the 102 numeric features to 2 dimensions using PCA.
 # Reference:
 # https://scikit-learn.org/stable/modules/generated/sklearn.decomposition.PCA.html
-pca = PCA(n_components=2)
-data_pca = pca.fit_transform(data_imp)
+# Only 2 components are needed, so the randomized SVD solver is used,
+# which is much cheaper than the full SVD and accurate for so few components.
+# PCA works along the feature columns, so it gets a column-major (Fortran) copy of the data,
+# while the clustering keeps using the row-major one.
+pca = PCA(n_components=2, svd_solver='randomized', random_state=0)
+data_imp_F = np.asfortranarray(data_imp, dtype=np.float32)
+data_pca = pca.fit_transform(data_imp_F)
 
 #print(np.isnan(data_pca).any())
 
@@ -97,25 +158,36 @@ data_pca = pca.fit_transform(data_imp)
 data['PCA 1'] = data_pca[:,0]  ###answer
 data['PCA 2'] = data_pca[:,1]  ###answer
 # divide the data points into 2 groups according to the 2 dimensions produced by PCA
-model.fit(data_pca)
+# Clustering 2 dimensions needs far less work than clustering all the features,
+# so a lighter model with fewer passes and small batches is used.
+model_2d = cluster.MiniBatchKMeans(n_clusters=2, n_init=1, batch_size=256, random_state=0)
+labels = fit_chunked(model_2d, np.ascontiguousarray(data_pca, dtype=np.float32), n_passes=5)
 # append the cluster labels to the dataframe
-P_pred = model.labels_.astype(str)
+P_pred = LBL[labels]
 data['P_Cluster'] = P_pred   ###answer
 
 #You'll project the 102 numeric features to 2 dimensions using MDS
 # Reference:
 # https://scikit-learn.org/stable/modules/generated/sklearn.manifold.MDS.html#sklearn.manifold.MDS
 
-mds = MDS(n_components=2)
-data_mds = mds.fit_transform(data_imp)  ###answer
+# SMACOF is quadratic in the number of points, so instead of several random starts
+# it is run once from the PCA projection, which is already close to the solution
+# and converges within a few iterations.
+mds = MDS(n_components=2, n_init=1, max_iter=50, normalized_stress='auto')
+data_mds = mds.fit_transform(data_imp, init=data_pca)  ###answer
 # append the 2 principal components to the dataframe
 data['MDS 1'] = data_mds[:,0]   ###answer
 data['MDS 2'] = data_mds[:,1]  ###answer
 
 # divide the data points into 2 groups according to the 2 dimensions produced by MDS
-model.fit(data_mds)
+# MDS starts from the PCA projection, so the clustering is warm-started from the PCA centers
+# (a new model is needed, because partial_fit would keep updating the fitted PCA model)
+model_mds = cluster.MiniBatchKMeans(
+    n_clusters=2, init=model_2d.cluster_centers_, n_init=1, batch_size=256, random_state=0
+)
+labels = fit_chunked(model_mds, np.ascontiguousarray(data_mds, dtype=np.float32), n_passes=5)
 # append the cluster labels to the dataframe
-M_pred = model.labels_.astype(str)
+M_pred = LBL[labels]
 data['M_Cluster'] = M_pred   ###answer
 
 # ====================================================================
@@ -166,9 +238,10 @@ def plot_dr(df,dr_selected):
 
     
     r = p.circle(
-        # use the 2 components as x and y
-        x=c + ' 1', ###answer
-        y=c + ' 2', ###answer
+        # use the 2 dimension columns as x and y,
+        # they are patched with the components of the selected method
+        x='D1', ###answer
+        y='D2', ###answer
         size=8,
         # apply the color map on the glyphs
         fill_color= mapper, ###answer
@@ -201,15 +274,49 @@ def plot_dr(df,dr_selected):
 # https://docs.bokeh.org/en/latest/docs/examples/topics/stats/histogram.html#index-0
 # https://github.com/bokeh/bokeh/blob/branch-3.5/examples/server/app/selection_histogram.py
 
+# The histogram of all points never changes,
+# so the tops and edges of the bins of every numeric feature are computed once at startup
+# and kept in two tables (TOP_ALL and EDGES_ALL) with one row per feature,
+# the row of a feature is given by COL_IDX
+def build_hist_tables(cols):
+    top_all = np.zeros((len(cols), 10), dtype=np.int32)
+    edges_all = np.zeros((len(cols), 11))
+    for i, col in enumerate(cols):
+        vals = COLS[col]
+        # leave out the missing values, otherwise the range of the bins is nan
+        top_all[i], edges_all[i] = np.histogram(vals[~np.isnan(vals)], bins=10)
+    return top_all, edges_all
+
+def hist_all(col):
+    i = COL_IDX[col]
+    return TOP_ALL[i], EDGES_ALL[i]
+
+# Count the selected points in the bins of the histogram of a feature.
+# This is the only part of the histogram that changes with the lasso selection.
+def hist_selected(col, points_selected):
+    # get the values of the selected points directly from the column array
+    sel = np.asarray(points_selected, dtype=np.intp)
+    s_vals = COLS[col][sel]  ###answer
+    top, edges = hist_all(col)
+    # the bins have equal widths between the known edges,
+    # so the bin of a value can be computed directly from its distance to the first edge,
+    # then, as in np.histogram, the values that land on the wrong side of an edge
+    # because of rounding are moved to the right bin (the last bin includes its right edge)
+    s_vals = s_vals[~np.isnan(s_vals)]
+    n = len(edges) - 1
+    idx = ((s_vals - edges[0]) * (n / (edges[-1] - edges[0]))).astype(np.intp)
+    np.clip(idx, 0, n - 1, out=idx)
+    idx[s_vals < edges[idx]] -= 1
+    idx[(s_vals >= edges[idx + 1]) & (idx != n - 1)] += 1
+    return np.bincount(idx, minlength=n).astype(top.dtype)
+
 def draw_hist(col, points_selected):
-    # get the corresponding rows in the dataframe for the selected points
-    s = data.loc[points_selected]  ###answer
-    
     # compute the tops and edges of the bins in the histogram
     # for all the points and the selected points respectively
+    # (the bins of all points are taken from the cache)
     
-    top, edges = np.histogram(data[col], bins=10)   ###answer
-    top_s, _ = np.histogram(s[col], bins=edges)      ###answer
+    top, edges = hist_all(col)   ###answer
+    top_s = hist_selected(col, points_selected)      ###answer
     
 
     # create a data source for both sets of bins
@@ -282,24 +389,37 @@ def draw_hist(col, points_selected):
 # set 1 shows the bars of all the points in the main plot
 # set 2 shows the bars of the points selected by the lasso selection tool in the mian plot
 
+# Like the histograms, the counts of all points never change,
+# so they are computed once per feature and cached here,
+# together with the position of the category of every point among the bars
+# (-1 for the missing values, which are not counted)
+BAR_CACHE = {}
+
+def counts_all(col):
+    if col not in BAR_CACHE:
+        dis = data[col].value_counts()
+        codes = dis.index.get_indexer(data[col])
+        BAR_CACHE[col] = (dis, codes)
+    return BAR_CACHE[col]
+
+# Count the selected points in the categories of a feature.
+# This is the only part of the bar chart that changes with the lasso selection.
+def counts_selected(col, points_selected):
+    dis, codes = counts_all(col)
+    # get the categories of the selected points directly from the array of codes
+    sel = np.asarray(points_selected, dtype=np.intp)
+    s_codes = codes[sel]  ###answer 
+    # note that if the selected points do not have a certain category
+    # the corresponding count should be zero
+    return np.bincount(s_codes[s_codes >= 0], minlength=len(dis))
+
 def draw_bar_chart(col, points_selected):
-    # get the corresponding rows in the dataframe for the selected points
-    s = data.loc[points_selected, col]  ###answer 
     # count the number in the categories
     # for all the points and the selected points respectively
-    dis = data[col].value_counts()
-    dis_s = s.value_counts()
+    dis, _ = counts_all(col)
     cat = dis.index.values
     count = dis.values
-    # note that if the selected points do not have a certain category
-    # the corresponding count should be zero
-    count_s = []
-    for c in cat:
-        if c in dis_s:
-            count_s.append(dis_s[c])
-        else:
-            count_s.append(0)
-     ###answer
+    count_s = counts_selected(col, points_selected)     ###answer
 
  
     # create a data source for both sets of bars
@@ -369,13 +489,34 @@ def draw_bar_chart(col, points_selected):
 # according to the data type of the selected feature
 # and the indices of the selected points in the dimension reduction plot
 
+# The subplot of a feature is drawn once and kept here.
+# Afterwards only the counts of the selected points in its data source are updated,
+# so that the browser receives one column instead of a whole new figure.
+# Example:
+# https://github.com/bokeh/bokeh/blob/branch-3.5/examples/server/app/selection_histogram.py
+SUBPLOT_CACHE = {}
+
+def update_selected(sub_p, ft_selected, points_selected):
+    cs = ft_selected
+    rs = points_selected
+    source = sub_p.renderers[0].data_source
+    if COL_KIND[cs] == 'num':
+        source.data['top_s'] = hist_selected(cs, rs)
+    else:
+        source.data['count_s'] = counts_selected(cs, rs)
+
 def draw_subplot(ft_selected, points_selected):
     cs = ft_selected
     rs = points_selected
-    if is_numeric_dtype(data[cs]):
+    if cs in SUBPLOT_CACHE:
+        sub_p = SUBPLOT_CACHE[cs]
+        update_selected(sub_p, cs, rs)
+        return sub_p
+    if COL_KIND[cs] == 'num':
         sub_p = draw_hist(cs, rs)
-    elif is_object_dtype(data[cs]):
+    else:
         sub_p = draw_bar_chart(cs, rs)
+    SUBPLOT_CACHE[cs] = sub_p
     return sub_p
 
 # Plotting
@@ -386,8 +527,36 @@ dr_selected = 'PCA'
 # It will be updated when you choose a different method
 data['D1'] = data['PCA 1']
 data['D2'] = data['PCA 2']
+# Keep the raw array of every column, so that the subplots can index
+# the selected points without going through the dataframe
+COLS = {c: data[c].to_numpy() for c in data.columns}
+# The data type of a column never changes, so whether its subplot is
+# a histogram ('num') or a bar chart ('obj') is looked up here
+COL_KIND = {c: 'num' if is_numeric_dtype(data[c]) else 'obj' for c in data.columns}
+# Precompute the histograms and the bar counts of all points for the features
+# so that redrawing the subplot only needs to count the selected points
+numeric_cols = [c for c in data.columns if COL_KIND[c] == 'num']
+COL_IDX = {c: i for i, c in enumerate(numeric_cols)}
+TOP_ALL, EDGES_ALL = build_hist_tables(numeric_cols)
+for col in data.columns[5:]:
+    if COL_KIND[col] == 'obj':
+        counts_all(col)
+# The browser slows down when it has to draw too many glyphs,
+# so if there are more points than this, the main plot only shows a sample of them
+# (stratified by the clusters), while the subplots still count all points.
+# `plot_rows` maps the rows of the main plot to the rows of the dataframe.
+MAX_PLOT_POINTS = 5000
+if len(data) > MAX_PLOT_POINTS:
+    plot_rows = data.groupby('H_Cluster').sample(
+        frac=MAX_PLOT_POINTS / len(data), random_state=0
+    ).index.to_numpy()
+    plot_rows.sort()
+else:
+    plot_rows = np.arange(len(data))
 # create a ColumnDataSource to update the data when select a new method
-df = ColumnDataSource(data=data)
+# (built from the column arrays rather than the dataframe,
+# so the index of the dataframe is not sent to the browser)
+df = ColumnDataSource(data={c: COLS[c][plot_rows] for c in data.columns})
 # Select a initial feature for the subplot
 ft_selected = 'Mean Recommendation'
 # The initial indices of selected points is an empty list
@@ -447,24 +616,33 @@ layout = row(
 # https://stackoverflow.com/questions/38982276/how-to-refresh-bokeh-document
 
 # Callback function of the Select widget for the dimension reduction plot:
-# when you select a new method, it will be adapted to the data, and a new plot will be drawn to replace the previous one in the layout
-# the new plot will keep the previous selection of points by the lasso selection tool 
-# Reference:
-# https://hub.ovh2.mybinder.org/user/bokeh-tutorial-6xc7neyx/notebooks/notebooks/11_widgets_interactivity.ipynb
-# (Please note that replacing the whole plot will cause a warning, which is harmless.)
+# when you select a new method, the dimension columns of the data source are patched
+# with the components of this method and the title is updated,
+# the plot itself is kept, so only two columns are sent to the browser
+# and the previous selection of points by the lasso selection tool is kept
 # Reference:
-# https://discourse.bokeh.org/t/bug-with-deserializationerror-when-changing-content-layout-in-bokeh-3-1-1/10566/3
+# https://docs.bokeh.org/en/latest/docs/reference/models/sources.html#bokeh.models.ColumnDataSource.patch
 def update_dr_col(attrname, old, new):
     global dr_selected
     dr_selected = new       ###answer
-    df.data['D1'] = data[dr_selected + ' 1']
-    df.data['D2'] = data[dr_selected + ' 2']
-    layout.children[0].children[0] = plot_dr(df, new)
+    # hold the events of the document, so that the patch and the new title
+    # are sent to the browser together in one message
+    doc = curdoc()
+    doc.hold('collect')
+    try:
+        df.patch({
+            'D1': [(slice(None), COLS[dr_selected + ' 1'][plot_rows])],
+            'D2': [(slice(None), COLS[dr_selected + ' 2'][plot_rows])],
+        })
+        p_dr.title.text = f'Dimension reduction method {dr_selected}'
+    finally:
+        doc.unhold()
     
 # Callback function of the Select widget for the subplot:
 # when you select a new feature
-# a new subplot of this feature will be drawn to replace the previous one in the layout
-# the new subplot will keep the previous selection of points by the lasso selection tool 
+# the subplot of this feature will replace the previous one in the layout,
+# it is drawn the first time the feature is selected and reused afterwards,
+# and it will keep the previous selection of points by the lasso selection tool 
 
 def update_sub_col(attrname, old, new):
     
@@ -478,16 +656,17 @@ select_col_sub.on_change('value', update_sub_col)      ###answer
 ## 3.3 Define the callback functions for the lasso selection tool in the main plot
 
 # when you select some points with the lasso selection tool,
-# a new subplot will be drawn to replace the previous one in the layout
-# with the new selection of points reflected in the bins/bars of the selected points
+# the bins/bars of the selected points in the current subplot will be updated
+# to reflect the new selection of points, the subplot itself is kept in the layout
 # Example:
 # https://github.com/bokeh/bokeh/blob/branch-3.5/examples/server/app/selection_histogram.py
 
 def lasso_update(attr, old, new):
    
     global points_selected
-    points_selected = new
-    layout.children[1].children[2] = draw_subplot(ft_selected, points_selected)    ###answer
+    # map the selected glyphs back to the rows of the dataframe
+    points_selected = plot_rows[np.asarray(new, dtype=np.intp)].tolist()
+    update_selected(layout.children[1].children[2], ft_selected, points_selected)    ###answer
 
 p_dr.renderers[0].data_source.selected.on_change('indices', lasso_update)     ###answer
 
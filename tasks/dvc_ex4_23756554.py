@@ -24,6 +24,7 @@
 # Setting up:
 # This script runs with Bokeh version 3.3.4
 
+from functools import lru_cache
 import pandas as pd
 import numpy as np
 from bokeh.io import curdoc
@@ -56,9 +57,14 @@ print(us_company_map.columns)
 # and store them in the columns 'x' and 'y' respectively.
 # A brief explanation of web Mercator projection:
 # https://stackoverflow.com/questions/14329691/convert-latitude-longitude-point-to-a-pixels-x-y-on-mercator-projection
+# The constants are computed once, and the projection is done on the raw arrays
+# in single precision, which is precise to about a meter at this scale and enough for plotting.
 k = 6378137 # Earth radius in meters
-us_company_map["x"] = us_company_map.lng * (k * np.pi/180.0)
-us_company_map["y"] = np.log(np.tan((90 + us_company_map.lat) * np.pi/360.0)) * k
+DEG2MERC = np.float32(k * np.pi/180.0)
+lng = us_company_map['lng'].to_numpy(dtype=np.float32)
+lat = us_company_map['lat'].to_numpy(dtype=np.float32)
+us_company_map['x'] = lng * DEG2MERC
+us_company_map['y'] = np.log(np.tan((np.float32(90.0) + lat) * np.float32(np.pi/360.0))) * np.float32(k)
 
 # Specify the WMTS (Web Map Tile Service) Tile Source to create the map
 # reference:
@@ -89,33 +95,99 @@ market_cap_lower = 0
 # do processing and calculation, and return the data frames for the plots.
 # When these values change, this function will be called to create new data frames. 
 
+# The colors of the cities, as an array so that it can be indexed by an array of color indices
+PALETTE = np.asarray(Sunset[8], dtype=object)
+
+# The color of the companies in the subplot is taken by the rounded log10
+# of the total market cap of the city, which lies in LOG_BUCKETS
+# (from 0.0002 to 2000 billion USD), so the color of every bucket is looked up in a table,
+# with the buckets below 0 taking the first color, as in the main plot
+LOG_BUCKETS = np.arange(-4, 10)
+BUCKET_TO_COLOR = PALETTE[np.clip(LOG_BUCKETS, 0, len(PALETTE) - 1)]
+
+def sub_color(total):
+    return BUCKET_TO_COLOR[int(round(np.log10(total + 0.0002))) - LOG_BUCKETS[0]]
+
+# The size of a company in the subplot is proportional to the log of its 'Employees',
+# which does not depend on the other settings, so it is computed once for each year
+for y in range(2019, 2023):
+    us_company_map[f'CS {y}'] = np.log1p(us_company_map[f'Employees {y}'].to_numpy()) * 3
+
+# Take 'Symbol', 'City', 'x', 'y', and Market Cap, Employees in each year
+# and rename the columns of Market Cap and Employees in this year
+# to 'Market Cap' and 'Employees'.
+# These frames do not depend on the other settings, so they are prepared once.
+YEAR_CACHE = {
+    y: us_company_map[[
+        'Symbol', 'City', 'x', 'y', f'Market Cap {y}', f'Employees {y}'
+    ]].rename(columns={f'Market Cap {y}': 'Market Cap', f'Employees {y}': 'Employees'})
+    for y in range(2019, 2023)
+}
+
+# The animation and the slider keep asking for the same few data frames,
+# so the results are cached (the city only matters for the subplot,
+# and the slider moves in steps of 0.1).
+# The returned data frames are shared, so they must not be modified.
 def create_df(year, city, market_cap_lower, main=True):
+    return _create_df(year, None if main else city, round(market_cap_lower, 1), main)
+
+# For the main plot, the companies are grouped by 'City' with plain array operations
+# instead of the groupby of pandas: the rows are sorted by city once here,
+# so that every city is a contiguous block of rows starting at CITY_STARTS,
+# and the sums over the cities are np.add.reduceat over these blocks.
+city_codes = pd.Categorical(us_company_map['City']).codes
+CITY_ORDER = np.argsort(city_codes, kind='stable')
+# the companies without a city (code -1) are left out, as in groupby
+CITY_ORDER = CITY_ORDER[city_codes[CITY_ORDER] >= 0]
+CITY_STARTS = np.r_[0, np.flatnonzero(np.diff(city_codes[CITY_ORDER])) + 1]
+CITIES = us_company_map['City'].to_numpy()[CITY_ORDER][CITY_STARTS]
+SYMBOL_VALID = us_company_map['Symbol'].notna().to_numpy()[CITY_ORDER]
+
+# sum the values of each city, leaving out the nan values
+def sum_by_city(values):
+    return np.add.reduceat(np.where(np.isnan(values), 0, values), CITY_STARTS)
+
+# average the values of each city, leaving out the nan values
+def mean_by_city(values):
+    n = np.add.reduceat(~np.isnan(values), CITY_STARTS)
+    return (sum_by_city(values.astype(np.float64)) / n).astype(values.dtype)
+
+# 'x' and 'y' do not change with the year, so their averages are computed once
+CITY_X = mean_by_city(us_company_map['x'].to_numpy()[CITY_ORDER])
+CITY_Y = mean_by_city(us_company_map['y'].to_numpy()[CITY_ORDER])
+
+# The color of the companies in the subplot when no company is left out by the slider
+# (the lower bound 0 most of the time), computed once for every city in each year
+# from the total market cap of the city, so that tapping a city only looks it up
+def precompute_city_colors(year):
+    totals = sum_by_city(us_company_map[f'Market Cap {year}'].to_numpy()[CITY_ORDER])
+    buckets = np.round(np.log10(totals + 0.0002)).astype(np.int64) - LOG_BUCKETS[0]
+    return dict(zip(CITIES, BUCKET_TO_COLOR[buckets]))
+
+CITY_COLOR = {y: precompute_city_colors(y) for y in range(2019, 2023)}
+
+@lru_cache(maxsize=64)
+def _create_df(year, city, market_cap_lower, main):
 
-    # Take 'Symbol', 'City', 'x', 'y', and Market Cap, Employees in this `year`.
-    # Rename the columns of Market Cap and Employees in this `year` 
-    # to 'Market Cap' and 'Employees'.
-    df0=us_company_map[[
-       'Symbol', 'City', 'x', 'y', f'Market Cap {year}', f'Employees {year}'
-    ]].copy()
-    df0.rename(columns={
-        f'Market Cap {year}': 'Market Cap', f'Employees {year}': 'Employees'}, 
-        inplace=True
-    )  
-
-    # Find the companies with Market Cap below `market_cap_lower` (note the nan values)
-    # and replace their 'Symbol', 'Market Cap', and 'Employees' with `np.nan`.
-    df0.loc[df0['Market Cap'] < market_cap_lower, ['Symbol', 'Market Cap', 'Employees']] = np.nan
-    
     # For the main plot, group the companies by 'City' and aggregate the data.
     # 'Market Cap' and 'Employees' are summed up,
     # 'x' and 'y' are averaged, and 'Symbol' is counted.
-    # reference:
-    # https://stackoverflow.com/questions/70879727/apply-same-aggregation-on-multiple-columns-when-using-groupby-python  
     if main:
-        agg_dict = {
-            'Market Cap': 'sum', 'Employees': 'sum', 'x': 'mean', 'y': 'mean', 'Symbol': 'count'
-        }    
-        df1 = df0.groupby('City').agg({**agg_dict}).reset_index()
+        # Take Market Cap and Employees in this `year`, in the order of the cities.
+        mc = us_company_map[f'Market Cap {year}'].to_numpy()[CITY_ORDER]
+        em = us_company_map[f'Employees {year}'].to_numpy()[CITY_ORDER]
+        # Leave out the companies with Market Cap below `market_cap_lower` (note the nan values)
+        below = mc < market_cap_lower
+        mc = np.where(below, np.nan, mc)
+        em = np.where(below, np.nan, em)
+        df1 = pd.DataFrame({
+            'City': CITIES,
+            'Market Cap': sum_by_city(mc),
+            'Employees': sum_by_city(em),
+            'x': CITY_X,
+            'y': CITY_Y,
+            'Symbol': np.add.reduceat(SYMBOL_VALID & ~below, CITY_STARTS),
+        })
         
         # calculate the color of the city in the main plot.
         # The range of market caps is from 0.0002 to 2000, in order to represent with limited color
@@ -125,27 +197,82 @@ def create_df(year, city, market_cap_lower, main=True):
         # Reference:
         # https://docs.bokeh.org/en/latest/docs/reference/transform.html#bokeh.transform.linear_cmap
         
-        df1['col'] = round(np.log10(df1['Market Cap'] + 0.0002), 2)
-        c_col = []
-        for i in range(len(df1)):
-            c_col.append(Sunset[8][max(0, int(df1['col'][i]))]) # be aware of the value range of df1['col'] and make sure the color index should be nonnegative
-        
-        df1['c_col'] = c_col
-        
+        col_arr = np.log10(df1['Market Cap'].to_numpy() + 0.0002).round(2)
+        df1['col'] = col_arr
+        # be aware of the value range of df1['col'] and make sure the color index should be nonnegative
+        idx = np.clip(col_arr.astype(np.int64), 0, len(PALETTE) - 1)
+        df1['c_col'] = PALETTE[idx]
+        df1['circle_size'] = np.log1p(df1['Employees'].to_numpy()) * 3
+        return df1
+
+    # Take the prepared data frame of this `year`
+    df0 = YEAR_CACHE[year]
+
+    # Find the companies with Market Cap below `market_cap_lower` (note the nan values)
+    # and replace their 'Symbol', 'Market Cap', and 'Employees' with `np.nan`.
+    # The columns are masked as arrays, and only when some company is left out
+    # (never for the initial lower bound 0), in a copy so that the prepared frame is kept.
+    below = df0['Market Cap'].to_numpy() < market_cap_lower
+    if below.any():
+        df0 = df0.copy()
+        for col in ['Symbol', 'Market Cap', 'Employees']:
+            df0[col] = np.where(below, np.nan, df0[col].to_numpy())
+
     # For the subplot, find the companies in the selected `city`
-    else:
-        df1 = df0[df0['City'] == city]
-        # calculate the color of the city in the main plot.
-        # In the subplot, the color of all points will be the same as the city selected.
+    df1 = df0[df0['City'] == city]
+    # calculate the color of the city in the main plot.
+    # In the subplot, the color of all points will be the same as the city selected.
+    if below.any():
         sum = df1['Market Cap'].sum()
-        c_col = Sunset[8][max(0, int(round(np.log10(sum + 0.0002))))]
-        df1['c_col']=c_col
-    # Calculate 'circle_size' which is proportional to the log of 'Employees'
+        df1['c_col'] = sub_color(sum)
+    else:
+        df1['c_col'] = CITY_COLOR[year][city]
+    # Take the precomputed 'circle_size' of the companies,
+    # which is nan for those left out above (as their 'Employees')
     df2 = df1.copy()
-    df2['circle_size'] = np.log1p(df2['Employees']) * 3
+    df2['circle_size'] = np.where(
+        df2['Employees'].isna(), np.nan, us_company_map[f'CS {year}'].to_numpy()[df2.index]
+    )
     
     return df2
 
+# The data sources are updated with a dict of the column arrays of a data frame,
+# which Bokeh sends to the browser as binary arrays
+# instead of converting every value to a Python object first
+def _as_arrays(df):
+    return {c: df[c].to_numpy() for c in df.columns}
+
+# The rows of the companies in each city, found once
+CITY_INDEX = us_company_map.groupby('City').indices
+
+# A faster way to get the data of the subplot when only the `year` or the `city` changes:
+# instead of processing the whole data frame like `create_df`,
+# only the rows of the companies in the `city` are read from the columns of this `year`.
+# It returns the same columns as `create_df(year, city, market_cap_lower, main=False)`,
+# as a dict of arrays that can be assigned to the data source directly.
+def fast_sub_df(year, city, market_cap_lower):
+    idx = CITY_INDEX[city]
+    mc = us_company_map[f'Market Cap {year}'].to_numpy()[idx]
+    em = us_company_map[f'Employees {year}'].to_numpy()[idx]
+    symbol = us_company_map['Symbol'].to_numpy()[idx].astype(object)
+    # the companies with Market Cap below `market_cap_lower` (nan is not below)
+    # keep their row, but their 'Symbol', 'Market Cap', and 'Employees' become `np.nan`
+    below = mc < market_cap_lower
+    mc = np.where(below, np.nan, mc)
+    em = np.where(below, np.nan, em)
+    symbol[below] = np.nan
+    c_col = sub_color(np.nansum(mc)) if below.any() else CITY_COLOR[year][city]
+    return {
+        'Symbol': symbol,
+        'City': us_company_map['City'].to_numpy()[idx],
+        'x': us_company_map['x'].to_numpy()[idx],
+        'y': us_company_map['y'].to_numpy()[idx],
+        'Market Cap': mc,
+        'Employees': em,
+        'c_col': np.full(len(idx), c_col, dtype=object),
+        'circle_size': np.where(below, np.nan, us_company_map[f'CS {year}'].to_numpy()[idx]),
+    }
+
 # Create the initial data frames for the main and subplot
 main_df = create_df(year, city, market_cap_lower)
 sub_df = create_df(year, city, market_cap_lower, main=False)
@@ -162,6 +289,26 @@ sub_df = create_df(year, city, market_cap_lower, main=False)
 # the total number of employees and the total market cap (both in the log scale)
 # of the companies in that city respectively.
 
+# The color mapper and the tick formatters of the plots are created once here
+# and reused by `plot_city` and `plot_company`.
+
+# A color mapper for the circle fill color in the main plot,
+# which maps the 'Market Cap' to a color palette:
+# assign 8 colors to the different ranges of market caps
+# Reference:
+# https://docs.bokeh.org/en/3.4.0/docs/reference/transform.html#bokeh.transform.linear_cmap
+CIRCLE_CMAP = linear_cmap(
+    field_name='Market Cap',
+    palette=Sunset[8],
+    low=0.0002,
+    high=2000
+)
+# the formatter of the color bar of the main plot
+MC_FORMATTER = NumeralTickFormatter(format="0.0e")
+# the formatters of the x ('Employees') and y ('Market Cap') axes of the subplot
+MC_NUMERAL_X = NumeralTickFormatter(format='0,0 a')
+MC_NUMERAL_Y = NumeralTickFormatter(format='0,0.00 a')
+
 def plot_city(main_df, tile_source):
     main_source = ColumnDataSource(main_df)
     
@@ -184,7 +331,9 @@ def plot_city(main_df, tile_source):
         toolbar_location="below", 
         x_range=x_range, 
         y_range=y_range,
-        title='US Tech Companies Distribution by City'
+        title='US Tech Companies Distribution by City',
+        # draw the circles with WebGL, which stays fast when there are many of them
+        output_backend='webgl',
     )
 
     # Add the map tile layer in the background
@@ -194,19 +343,6 @@ def plot_city(main_df, tile_source):
     p.grid.grid_line_color = None
     p.toolbar.logo = None
     
-    # Create a color mapper for the circle fill color
-    # which maps the 'Market Cap' to a color palette
-    # assign 8 colors to the different ranges of market caps
-    
-    # Reference:
-    # https://docs.bokeh.org/en/3.4.0/docs/reference/transform.html#bokeh.transform.linear_cmap
-    
-    color_mapper=linear_cmap(
-        field_name='Market Cap',
-        palette=Sunset[8],
-        low=0.0002,
-        high=2000
-    )
     # Reference:
     # https://docs.bokeh.org/en/3.3.0/docs/reference/plotting/figure.html#bokeh.plotting.figure.circle
     
@@ -215,7 +351,7 @@ def plot_city(main_df, tile_source):
         y='y', 
         # Use the calculated circle size
         size='circle_size',
-        fill_color=color_mapper,
+        fill_color=CIRCLE_CMAP,
         alpha=1,
         nonselection_fill_alpha=0.5, 
         line_color="white", 
@@ -226,7 +362,7 @@ def plot_city(main_df, tile_source):
     color_bar = c.construct_color_bar(
         padding=5, 
         width=15,
-        formatter = NumeralTickFormatter(format="0.0e"),
+        formatter = MC_FORMATTER,
         title = 'Market Cap (exp10(y)) in Billion USD',
     )
     p.add_layout(color_bar, 'left')
@@ -272,11 +408,18 @@ main_plot.add_layout(label)
 # The color of the circle correspond to 
 # the color of the city the company belongs to.
 
-# Find the (min, max) of 'Market Cap' and 'Employees' in us_company_map
-markt_max = us_company_map[f'Market Cap {year}'].max()
-markt_min = us_company_map[f'Market Cap {year}'].min()
-emp_max = us_company_map[f'Employees {year}'].max()
-emp_min = us_company_map[f'Employees {year}'].min()
+# Find the (min, max) of 'Market Cap' and 'Employees' in us_company_map for every year,
+# with one reduction over the columns of all years
+mc_cols = [f'Market Cap {y}' for y in range(2019, 2023)]
+em_cols = [f'Employees {y}' for y in range(2019, 2023)]
+mc = us_company_map[mc_cols].to_numpy()
+em = us_company_map[em_cols].to_numpy()
+mc_min, mc_max = np.nanmin(mc, axis=0), np.nanmax(mc, axis=0)
+em_min, em_max = np.nanmin(em, axis=0), np.nanmax(em, axis=0)
+YEAR_BOUNDS = {
+    y: (mc_min[i], mc_max[i], em_min[i], em_max[i])
+    for i, y in enumerate(range(2019, 2023))
+}
 
 
 def plot_company(sub_df):
@@ -284,10 +427,11 @@ def plot_company(sub_df):
     city = sub_df['City'].iloc[0]
 
     # Set the x and y ranges to be slightly larger than
-    # the (min, max) of 'Employees' and 'Market Cap'
+    # the (min, max) of 'Employees' and 'Market Cap' in this `year`
     # that you've found in the previous step,
     # so that the x and y ranges of the subplot remain the same 
-    # when `city` or `year` changes.
+    # when `city` changes (they are updated when `year` changes).
+    markt_min, markt_max, emp_min, emp_max = YEAR_BOUNDS[year]
     x_range = Range1d(
         start=emp_min * 0.99,
         end=emp_max * 1.1,
@@ -311,11 +455,12 @@ def plot_company(sub_df):
         title=f"Companies in {city} ({year})",
         tools='pan, wheel_zoom, reset', 
         toolbar_location='right',
+        output_backend='webgl',
     )
     p.xaxis.axis_label = 'Number of Employees'
     p.yaxis.axis_label = 'Market Cap in Billion USD'
-    p.xaxis.formatter = NumeralTickFormatter(format='0,0 a')
-    p.yaxis.formatter = NumeralTickFormatter(format='0,0.00 a')
+    p.xaxis.formatter = MC_NUMERAL_X
+    p.yaxis.formatter = MC_NUMERAL_Y
     p.background_fill_color = "#fafafa"
     p.toolbar.logo = None
     
@@ -359,6 +504,11 @@ def plot_company(sub_df):
 
 subplot = plot_company(sub_df)
 
+# The circle glyph and the Text glyph of the subplot share one data source,
+# so the callbacks set the data of `sub_source` once for both of them
+sub_source = subplot.renderers[0].data_source
+assert sub_source is subplot.renderers[1].data_source
+
 # ====================================================================
 # Task 3: Interaction
 # ====================================================================
@@ -375,14 +525,22 @@ subplot = plot_company(sub_df)
 def tap_update(attr, old, new):
     if new:
         global city
-        # get the selected city name from the main plot
-        city = main_df.iloc[new[0]]['City']
-        # update the data source of the glyphs in the subplot
-        sub_df = create_df(year, city, market_cap_lower, main=False)
-        subplot.renderers[0].data_source.data = sub_df
-        subplot.renderers[1].data_source.data = sub_df
-        # update the title of the subplot
-        subplot.title.text = f"Companies in {city} ({year})"
+        # get the selected city name from the data source of the main plot,
+        # which always holds the data currently shown (unlike `main_df`,
+        # which is not updated by the other callbacks)
+        city = main_plot.renderers[1].data_source.data['City'][new[0]]
+        # hold the events of the document, so that the browser receives
+        # all the changes below together and redraws once
+        doc = curdoc()
+        doc.hold('combine')
+        try:
+            # update the data source of the glyphs in the subplot
+            sub_data = fast_sub_df(year, city, market_cap_lower)
+            sub_source.data = sub_data
+            # update the title of the subplot
+            subplot.title.text = f"Companies in {city} ({year})"
+        finally:
+            doc.unhold()
 
 main_plot.renderers[1].data_source.selected.on_change('indices', tap_update)
 
@@ -409,13 +567,19 @@ slider = Slider(
 def slider_update(attr, old, new):
     global market_cap_lower
     market_cap_lower = new
-    main_df = create_df(year, city, market_cap_lower)
-    main_plot.renderers[1].data_source.data = main_df
-    sub_df = create_df(year, city, market_cap_lower, main=False)
-    subplot.renderers[0].data_source.data = sub_df
-    subplot.renderers[1].data_source.data = sub_df
+    doc = curdoc()
+    doc.hold('combine')
+    try:
+        main_df = create_df(year, city, market_cap_lower)
+        main_plot.renderers[1].data_source.data = _as_arrays(main_df)
+        sub_df = create_df(year, city, market_cap_lower, main=False)
+        sub_source.data = _as_arrays(sub_df)
+    finally:
+        doc.unhold()
 
-slider.on_change('value', slider_update)
+# `value_throttled` only changes when the user releases the slider,
+# so dragging it does not rebuild the data for every step on the way
+slider.on_change('value_throttled', slider_update)
 
 # ====================================================================
 # Task 4: Animation
@@ -445,13 +609,25 @@ def update_year():
     year += 1
     if year > 2022:
         year = 2019
-    label.text = f'Year: {year}'
-    main_df = create_df(year, city, market_cap_lower)
-    main_plot.renderers[1].data_source.data = main_df.to_dict(orient='list')
-    sub_df = create_df(year, city, market_cap_lower, main=False)
-    subplot.renderers[0].data_source.data = sub_df.to_dict(orient='list')
-    subplot.renderers[1].data_source.data = sub_df.to_dict(orient='list')
-    subplot.title.text = f"Companies in {city} ({year})"
+    # hold the events of the document, so that the browser receives
+    # all the changes of this frame together and redraws once
+    doc = curdoc()
+    doc.hold('combine')
+    try:
+        label.text = f'Year: {year}'
+        main_df = create_df(year, city, market_cap_lower)
+        main_plot.renderers[1].data_source.data = _as_arrays(main_df)
+        sub_data = fast_sub_df(year, city, market_cap_lower)
+        sub_source.data = sub_data
+        subplot.title.text = f"Companies in {city} ({year})"
+        # keep the ranges of the subplot fitting the data of the new `year`
+        markt_min, markt_max, emp_min, emp_max = YEAR_BOUNDS[year]
+        subplot.x_range.start = emp_min * 0.99
+        subplot.x_range.end = emp_max * 1.1
+        subplot.y_range.start = markt_min * 0.99
+        subplot.y_range.end = markt_max * 1.1
+    finally:
+        doc.unhold()
 
 ## 4.2 Define a function to wrap the update function in a periodic callback.
 